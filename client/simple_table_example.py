@@ -1,27 +1,44 @@
 # A Simple Python program with the functionality of the `simple_table_example` Jupyter Notebook
 # (c) 2024 Regents of the University of California
 import requests
+from json import dumps
 server_url = 'http://localhost:5001'
+
+# A local cache of results, keyed by request.  Each entry is (etag, result).  The servers answer a request
+# whose If-None-Match header matches the cached ETag with an empty 304, and the cached result is reused
+cache = {}
+
+def cached_request(method, url, json = None):
+    key = (method, url, dumps(json))
+    entry = cache.get(key)
+    headers = {'If-None-Match': entry[0]} if entry is not None else {}
+    response = requests.request(method, url, json = json, headers = headers)
+    if response.status_code == 304:
+        return entry[1]
+    response.raise_for_status()
+    result = response.json()
+    etag = response.headers.get('ETag')
+    if etag is not None:
+        cache[key] = (etag, result)
+    return result
+
 response = requests.get(server_url)
 print('Server Routes')
 print(response.json())
 table_names = f'{server_url}/get_table_names'
-response = requests.get(table_names)
 print('Names of the hosted tables')
-print(response.json())
+print(cached_request('GET', table_names))
 print('Get the range of the Year Column of Nationwide Vote')
-response = requests.get(f'{server_url}/get_range_spec?table_name=nationwide_vote&column_name=Year')
-response.json()
+print(cached_request('GET', f'{server_url}/get_range_spec?table_name=nationwide_vote&column_name=Year'))
 print('Get the values of all of the parties that have ever run in the US')
-response = requests.get(f'{server_url}/get_all_values?table_name=nationwide_vote&column_name=Party')
-response.json()
+print(cached_request('GET', f'{server_url}/get_all_values?table_name=nationwide_vote&column_name=Party'))
 print('Get the schema of the Presidential Vote Table')
-response = requests.get(f'{server_url}/get_table_schema?table_name=presidential_vote')
-response.json()
+print(cached_request('GET', f'{server_url}/get_table_schema?table_name=presidential_vote'))
 print('Show the years when a candidate named Roosevelt ran for the Presidency')
 filter_name = {"operator": "REGEX_MATCH", "column": "Name", "expression": ".*Roosevelt.*"}
 filter_state = {"operator": "IN_LIST", "column": "State", "values": ["Nationwide"]}
 all_filter = {"operator": "ALL", "arguments": [filter_name, filter_state]}
 query = {"table": "presidential_vote",  "filter": all_filter, "columns": ['Year', 'Name', 'Percentage']}
-response = requests.post(f'{server_url}/get_filtered_rows', json = query)
-response.status_code
\ No newline at end of file
+print(cached_request('POST', f'{server_url}/get_filtered_rows', json = query))
+print('Ask again: the server answers with a 304, and the result comes from the local cache')
+print(cached_request('POST', f'{server_url}/get_filtered_rows', json = query))
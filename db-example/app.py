@@ -46,12 +46,13 @@ This is a very thin overlay on the server in sdtp_server.py, with a /, /help met
 
 from sdtp import sdtp_server_blueprint, SDMLTable,  jsonifiable_column, jsonifiable_rows
 from sdtp import  SDML_NUMBER, SDML_BOOLEAN, SDML_DATE, SDML_DATETIME, SDML_TIME_OF_DAY, SDML_STRING
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
 
 import sqlite3
 import re
-from sqlite_interface import SDMLSqliteTable, SQLiteConnection
+from sqlite_interface import SDMLSqliteTable, SQLiteConnection, QueryBudget, QueryBudgetExceededException
+from conditional_caching import add_conditional_caching
 
 
 # schema = []
@@ -106,9 +107,20 @@ tables = {
     ]
 }
 
-connection = SQLiteConnection('presidential_vote.db')
+#
+# Query budgets.  Every query is limited in VM steps, wall-clock time, and rows returned, so a 
+# pathological query (e.g., a catastrophic REGEX_MATCH) can't tie up the connection.  default_budget applies
+# to every table not in table_budgets
+#
+default_budget = QueryBudget(max_steps = 2_000_000, max_seconds = 0.5, max_rows = 5_000)
+table_budgets = {
+    'presidential_vote': QueryBudget(max_steps = 10_000_000, max_seconds = 2.0, max_rows = 10_000)
+}
+
+db_file = 'presidential_vote.db'
+connection = SQLiteConnection(db_file, default_budget)
 for (name, schema) in tables.items():
-    table = SDMLSqliteTable(schema, connection, name)
+    table = SDMLSqliteTable(schema, connection, name, table_budgets.get(name))
     sdtp_server_blueprint.table_server.add_sdtp_table({'name': name, 'table': table})
 
 app = Flask(__name__)
@@ -118,11 +130,35 @@ app.config['CORS_HEADERS'] = 'Content-Type'
 app.register_blueprint(sdtp_server_blueprint)
 
 
+#
+# HTTP conditional caching (see conditional_caching.py)
+#
+
+def _table_version(table_name):
+    # SQLite has no per-table version, so every table shares the version of the database file, which changes
+    # when the file is written or replaced.  This reads no data, so a revalidation never waits on a query.
+    # (PRAGMA data_version can't be used: it is per connection, and each thread has its own connection)
+    if table_name is not None and table_name not in tables: return None
+    stat = os.stat(db_file)
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+add_conditional_caching(app, _table_version)
+
+
 additional_routes = [
      {"url": "/, /help", "headers": "", "method": "GET", "description": "print this message"},
      {"url": "/cwd", "headers": "", "method": "GET", "description": "Show the working directory on the server"},
+     {"url": "/get_query_aborts", "headers": "", "method": "GET", "description": "Show the number of queries aborted for exceeding their budget, by table and limit"},
 ]
 
+@app.errorhandler(QueryBudgetExceededException)
+def query_budget_exceeded(error):
+    '''
+    Report a query which exceeded its budget as a 422 with the error message
+    '''
+    app.logger.warning(str(error))
+    return str(error), error.status_code
+
 @app.route('/help', methods=['POST', 'GET'])
 @app.route('/', methods=['POST', 'GET'])
 def show_routes():
@@ -142,5 +178,10 @@ def cwd():
     return os.getcwd()
 
 
+@app.route('/get_query_aborts')
+def get_query_aborts():
+    return jsonify(connection.get_abort_counts())
+
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
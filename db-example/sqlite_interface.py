@@ -3,41 +3,243 @@ from sdtp import  SDML_NUMBER, SDML_BOOLEAN, SDML_DATE, SDML_DATETIME, SDML_TIME
 import sqlite3
 import re
 import datetime
+import time
+import threading
+import queue
+import functools
+from pathlib import Path
+
+try:
+    # The regex package (a requirement of this example, see README.md) supports a timeout on each match, so a
+    # single catastrophic match is bounded by the query's deadline.  Without it, a single re.search can't be
+    # interrupted, so patterns which can backtrack catastrophically are rejected instead (see _has_nested_repetition)
+    import regex as _regex_engine
+except ImportError:
+    _regex_engine = None
+
+# The longest REGEX_MATCH pattern accepted, and the longest value a pattern is matched against
+MAX_REGEX_PATTERN_LENGTH = 256
+MAX_REGEX_TEXT_LENGTH = 4096
+
+@functools.lru_cache(maxsize = 256)
+def _has_nested_repetition(pattern):
+    # True if pattern repeats (with *, + or {...}) a group which itself contains a quantifier or an alternation,
+    # e.g. (a+)+ or (a|a)*.  These are the patterns on which re can backtrack exponentially.  This is a
+    # conservative scan of the pattern text: it may reject some safe patterns, such as (ab|cd)+
+    stack = [False]  # for each open group, whether it contains a quantifier or alternation
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            # skip the character class, where quantifiers and parentheses are literal
+            i += 2 if pattern[i + 1:i + 2] == '^' else 1
+            if pattern[i:i + 1] == ']': i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif c == '(':
+            stack.append(False)
+        elif c == ')' and len(stack) > 1:
+            inner = stack.pop()
+            repeated = pattern[i + 1:i + 2] in ('*', '+', '{')
+            if inner and repeated: return True
+            stack[-1] = stack[-1] or inner or repeated
+        elif c in '*+{|' or (c == '?' and pattern[i - 1:i] != '('):
+            stack[-1] = True
+        i += 1
+    return False
+
+# The budget state of the query running on this thread.  Set by SQLiteConnection.execute_query_return_list,
+# and read by _sqlite_regex_match, which SQLite calls on the same thread
+_active_query = threading.local()
 
 def _sqlite_regex_match(pattern, text):
     # A utility which returns True if pattern matches any part of the given text.  
     # this is to be a callback for SQLite to define a regexp expression for the SQL REGEXP 
     # operator
-    return re.search(pattern, text) is not None
+    # SQLite counts each call as a single VM instruction, so the progress handler can't interrupt a slow
+    # match; instead, the query's deadline, the length limits, and (without the regex package) the ban on
+    # nested repetition are enforced here.  When a limit is
+    # exceeded, it is recorded in the query state and an exception is raised, which aborts the query
+    if text is None: return False
+    state = getattr(_active_query, 'state', None)
+    if state is None: return re.search(pattern, text) is not None
+    if len(pattern) > MAX_REGEX_PATTERN_LENGTH:
+        state['exceeded'] = ('max_regex_pattern_length', MAX_REGEX_PATTERN_LENGTH)
+    elif _regex_engine is None and _has_nested_repetition(pattern):
+        state['exceeded'] = ('regex_nested_repetition', 'not allowed unless the regex package is installed')
+    elif len(text) > MAX_REGEX_TEXT_LENGTH:
+        state['exceeded'] = ('max_regex_text_length', MAX_REGEX_TEXT_LENGTH)
+    elif state['deadline'] is not None and time.monotonic() >= state['deadline']:
+        state['exceeded'] = ('max_seconds', state['max_seconds'])
+    if state['exceeded'] is not None: raise ValueError(state['exceeded'])
+    if _regex_engine is None: return re.search(pattern, text) is not None
+    timeout = state['deadline'] - time.monotonic() if state['deadline'] is not None else None
+    try:
+        return _regex_engine.search(pattern, text, timeout = timeout) is not None
+    except TimeoutError:
+        state['exceeded'] = ('max_seconds', state['max_seconds'])
+        raise
+
+# The progress handler is called every PROGRESS_HANDLER_INTERVAL SQLite virtual machine instructions.
+# Smaller values give tighter enforcement of the step and time budgets at a (small) cost per query
+PROGRESS_HANDLER_INTERVAL = 1000
+
+class QueryBudget:
+    '''
+    Limits on the cost of a single query issued through a SQLiteConnection.  A limit of None means
+    that resource is not limited.
+    Properties:
+      -- max_steps: the maximum number of SQLite virtual machine instructions the query may execute
+      -- max_seconds: the maximum wall-clock time, in seconds, the query may run
+      -- max_rows: the maximum number of rows the query may return
+    '''
+    def __init__(self, max_steps = None, max_seconds = None, max_rows = None):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_rows = max_rows
+
+class QueryBudgetExceededException(Exception):
+    '''
+    Raised when a query exceeds one of the limits in its QueryBudget.  The query is aborted
+    and no partial result is returned.
+    Properties:
+      -- table_name: the table being queried (None if unknown)
+      -- limit_name: the limit which was exceeded ('max_steps', 'max_seconds', 'max_rows',
+         'max_regex_pattern_length', 'max_regex_text_length' or 'regex_nested_repetition')
+      -- limit: the value of the limit which was exceeded
+      -- status_code: the HTTP status a server should return, 422.  The query itself is too expensive,
+         so retrying it will fail the same way
+    '''
+    def __init__(self, table_name, limit_name, limit):
+        self.table_name = table_name
+        self.limit_name = limit_name
+        self.limit = limit
+        self.status_code = 422
+        super(QueryBudgetExceededException, self).__init__(
+            f'Query on table {table_name} aborted: exceeded {limit_name} = {limit}.  Narrow the filter or request fewer rows'
+        )
 
 class SQLiteConnection:
     '''
     Interface to a SQLite database.  Creates the connection, defines the regex function,
     and executes SQL queries on the DB, returning the results in a list.
+    Queries issued through execute_query_return_list are governed by a QueryBudget: a progress
+    handler aborts any query which runs too many VM steps or too long, the REGEXP function aborts
+    any query which passes its deadline or the regex length limits, and queries which return
+    too many rows are aborted with a QueryBudgetExceededException.  The number of aborts is recorded,
+    per table and per limit, in abort_counts.
+    Queries are run on read-only connections taken from a pool, so queries on different threads, and
+    their progress handlers, run independently, and connections are reused across requests.
     Arguments:
         db: name of the database file
+        default_budget: the QueryBudget used when a query doesn't supply one.  Default: no limits
+        pool_size: the maximum number of idle connections kept for reuse.  Default: 4
     '''
-    def __init__(self, db):
-        self.connection = sqlite3.connect(db, check_same_thread = False)
-        self.connection.create_function("REGEXP", 2, _sqlite_regex_match)
-        self.cursor = self.connection.cursor()
+    def __init__(self, db, default_budget = None, pool_size = 4):
+        self.db_uri = f'{Path(db).resolve().as_uri()}?mode=ro'
+        self.default_budget = default_budget if default_budget is not None else QueryBudget()
+        self._pool = queue.Queue(maxsize = pool_size)
+        # The connection used by execute_query_return_result, opened on first use
+        self._debug_connection = None
+        # table_name -> limit_name -> number of queries aborted, shared by all threads
+        self.abort_counts = {}
+        self._abort_lock = threading.Lock()
+
+    def _open_connection(self):
+        # Open a new read-only connection with the REGEXP function defined.  Connections move between
+        # threads through the pool, but only one thread uses a connection at a time
+        connection = sqlite3.connect(self.db_uri, uri = True, check_same_thread = False)
+        connection.create_function("REGEXP", 2, _sqlite_regex_match)
+        return connection
+
+    def _checkout(self):
+        # Take an idle connection from the pool, or open a new one if there is none
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._open_connection()
+
+    def _checkin(self, connection):
+        # Return a connection to the pool, or close it if the pool is full
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
 
     def execute_query_return_result(self, sql_query):
         '''
         Execute a SQL query and return the result, from which a fetchone() or fetchall() can be executed.
-        Provided primarily for testing and debugging purposes.
+        Provided primarily for testing and debugging purposes.  The query is not governed by a QueryBudget,
+        and runs on its own connection, outside the pool.
         '''
-        return self.cursor.execute(sql_query)
+        if self._debug_connection is None:
+            self._debug_connection = self._open_connection()
+        return self._debug_connection.execute(sql_query)
+
+    def _record_abort(self, table_name, limit_name, limit):
+        # Count the abort and return the exception to raise
+        with self._abort_lock:
+            table_counts = self.abort_counts.setdefault(table_name, {})
+            table_counts[limit_name] = table_counts.get(limit_name, 0) + 1
+        return QueryBudgetExceededException(table_name, limit_name, limit)
+
+    def get_abort_counts(self):
+        '''
+        Return a copy of abort_counts (table_name -> limit_name -> number of queries aborted), taken under the
+        lock, so it can be read while other threads are recording aborts
+        '''
+        with self._abort_lock:
+            return {table_name: dict(counts) for (table_name, counts) in self.abort_counts.items()}
 
-    def execute_query_return_list(self, sql_query, return_one = False):
+    def execute_query_return_list(self, sql_query, return_one = False, budget = None, table_name = None):
         '''
         Execute the SQL query.  If fetchone is true, return only one result.  Otherwise return all.  This
-        returns either a list or a list of lists, depending on the query
-
+        returns either a list or a list of lists, depending on the query.
+        Arguments:
+          - sql_query: the query to execute
+          - return_one: if True, return only the first result
+          - budget: the QueryBudget for this query.  If None, self.default_budget is used
+          - table_name: the table being queried, used in error messages and abort_counts
+        Raises:
+          - QueryBudgetExceededException if the query exceeds any limit in the budget
         '''
-        result = self.execute_query_return_result(sql_query)
-        return result.fetchone() if return_one else result.fetchall()
-
+        budget = budget if budget is not None else self.default_budget
+        connection = self._checkout()
+        deadline = time.monotonic() + budget.max_seconds if budget.max_seconds is not None else None
+        state = {'steps': 0, 'exceeded': None, 'deadline': deadline, 'max_seconds': budget.max_seconds}
+
+        def _check_budget():
+            # Called by SQLite every PROGRESS_HANDLER_INTERVAL instructions; a nonzero return aborts the query
+            state['steps'] += PROGRESS_HANDLER_INTERVAL
+            if budget.max_steps is not None and state['steps'] > budget.max_steps:
+                state['exceeded'] = ('max_steps', budget.max_steps)
+            elif deadline is not None and time.monotonic() > deadline:
+                state['exceeded'] = ('max_seconds', budget.max_seconds)
+            return 1 if state['exceeded'] is not None else 0
+
+        connection.set_progress_handler(_check_budget, PROGRESS_HANDLER_INTERVAL)
+        _active_query.state = state
+        cursor = connection.cursor()
+        try:
+            result = cursor.execute(sql_query)
+            if return_one: return result.fetchone()
+            if budget.max_rows is None: return result.fetchall()
+            # Fetch one more row than the budget allows, so an over-budget result is detected without reading all of it
+            rows = result.fetchmany(budget.max_rows + 1)
+            if len(rows) > budget.max_rows:
+                raise self._record_abort(table_name, 'max_rows', budget.max_rows)
+            return rows
+        except sqlite3.OperationalError:
+            if state['exceeded'] is not None:
+                raise self._record_abort(table_name, *state['exceeded'])
+            raise
+        finally:
+            cursor.close()
+            _active_query.state = None
+            connection.set_progress_handler(None, 0)
+            self._checkin(connection)
 
 '''
 Translation methods from atomic values in SDQL/SDML/ISO Format to SQLite SQL.  The translations are in 
@@ -212,11 +414,17 @@ class SDMLSqliteTable(SDMLTable):
       -- schema: the schema of the table
       -- connection: a SQLiteConnection which issues the queries and returns the results
       -- db_table: the name of the table to query
+      -- budget: the QueryBudget for queries on this table.  If None, the connection's default_budget is used
     '''
-    def __init__(self, schema, connection, db_table):
+    def __init__(self, schema, connection, db_table, budget = None):
         super(SDMLSqliteTable, self).__init__(schema)
         self.connection = connection
         self.db_table = db_table
+        self.budget = budget
+
+    def _execute(self, sql_query, return_one = False):
+        # Execute sql_query under this table's budget
+        return self.connection.execute_query_return_list(sql_query, return_one = return_one, budget = self.budget, table_name = self.db_table)
 
 
     def all_values(self, column, jsonify = False):
@@ -227,7 +435,7 @@ class SDMLSqliteTable(SDMLTable):
           - jsonify: return a form that can be converted to json if True
         '''
         sdml_type = self.get_column_type(column)
-        sql_result = self.connection.execute_query_return_list(f'Select DISTINCT {column} from {self.db_table}  ORDER BY {column};')
+        sql_result = self._execute(f'Select DISTINCT {column} from {self.db_table}  ORDER BY {column};')
         # The SQL result will be a list of tuples; only the first tuple contains the information we want
         result = [item[0] for item in sql_result]
         # Translate the result into an SDML list
@@ -241,7 +449,7 @@ class SDMLSqliteTable(SDMLTable):
           - jsonify: return a form that can be converted to json if True
         '''
         sdml_type = self.get_column_type(column)
-        result = self.connection.execute_query_return_list(f'Select  {column} from {self.db_table};')
+        result = self._execute(f'Select  {column} from {self.db_table};')
         return [translate_value_from_sql(value, sdml_type, jsonify) for value in result]
     
     def range_spec(self, column, jsonify = False):
@@ -252,7 +460,7 @@ class SDMLSqliteTable(SDMLTable):
           - jsonify: return a form that can be converted to json if True
         '''
         sdml_type = self.get_column_type(column)
-        result = self.connection.execute_query_return_list(f'Select min({column}), max({column}) from {self.db_table};', return_one = True) 
+        result = self._execute(f'Select min({column}), max({column}) from {self.db_table};', return_one = True) 
         return [translate_value_from_sql(value, sdml_type, jsonify) for value in result]
     
     # The remainder of this class is a set of methods to generate the WHERE clause in the SQL Select statement for get_filtered_rows.
@@ -333,7 +541,7 @@ class SDMLSqliteTable(SDMLTable):
         # if there are columns, select the column names, otherwise all columns
         columns_clause = ','.join(columns) if columns is not None and len(columns) > 0 else '*'
         # Form the sql query and execute it
-        rows = self.connection.execute_query_return_list(f'SELECT {columns_clause} from {self.db_table} {where_clause};')
+        rows = self._execute(f'SELECT {columns_clause} from {self.db_table} {where_clause};')
         # get the SDML types for the selected columns
         all_types = self.column_types()
         if columns is None or columns == []:
@@ -32,7 +32,8 @@
 import sys
 import os
 from glob import glob
-from json import load
+from json import loads
+import hashlib
 
 '''
 This is a simple SDTP Server, designed primarily for illustrative purposes -- this server is configured
@@ -47,6 +48,7 @@ from sdtp import sdtp_server_blueprint
 from flask import Flask
 from flask_cors import CORS
 from pathlib import Path
+from conditional_caching import add_conditional_caching
 
 
 app = Flask(__name__)
@@ -57,6 +59,13 @@ app.config['CORS_HEADERS'] = 'Content-Type'
 app.register_blueprint(sdtp_server_blueprint)
 
 
+#
+# The version of each table, used to compute ETags.  Tables are read once, when the server starts,
+# so the version of a table is the hash of its SDML file as loaded
+#
+
+table_versions = {}
+
 #
 # Load a table.  filename is a valid path and an SDML file.
 # 
@@ -64,9 +73,12 @@ app.register_blueprint(sdtp_server_blueprint)
 def _load_table(filename):
     # filename: path to an SDML file
     # The filename is <path>/table_name.sdml, stores this in table_name
-    with open(filename, 'r') as fp:
-        table_dictionary = load(fp)
-        sdtp_server_blueprint.table_server.add_sdtp_table_from_dictionary(Path(filename).stem, table_dictionary)
+    with open(filename, 'rb') as fp:
+        contents = fp.read()
+        table_name = Path(filename).stem
+        table_dictionary = loads(contents)
+        sdtp_server_blueprint.table_server.add_sdtp_table_from_dictionary(table_name, table_dictionary)
+        table_versions[table_name] = hashlib.sha256(contents).hexdigest()
 
 # 
 # Load all the tables on SDTP_PATH.  
@@ -80,6 +92,19 @@ if SDTP_PATH is not None and len(SDTP_PATH) > 0:
                 _load_table(filename)
 
 
+#
+# HTTP conditional caching (see conditional_caching.py).  The version of all tables combines the version of each
+#
+
+def _table_version(table_name):
+    # The version of table_name, or of all tables if table_name is None.  None if there is no such table
+    if table_name is None:
+        return '-'.join(f'{name}:{version}' for (name, version) in sorted(table_versions.items()))
+    return table_versions.get(table_name)
+
+add_conditional_caching(app, _table_version)
+
+
 additional_routes = [
      {"url": "/, /help", "headers": "", "method": "GET", "description": "print this message"},
      {"url": "/cwd", "headers": "", "method": "GET", "description": "Show the working directory on the server"},
@@ -0,0 +1,52 @@
+'''
+HTTP conditional caching for an SDTP server.  The results of the routes in CACHED_ROUTES depend only on the
+request and the version of the table(s) they read, so the ETag of a response is a hash of both.  A request
+whose If-None-Match header matches the ETag is answered with a 304 before the route runs.  The Simple Table
+Example and the SQLite Example each have a copy of this module, so each example stands alone; they differ only
+in the table_version function they pass to add_conditional_caching.
+'''
+import hashlib
+from flask import Response, g, request
+
+CACHED_ROUTES = {'/get_table_names', '/get_tables', '/get_table_schema', '/get_range_spec', '/get_all_values', '/get_column', '/get_filtered_rows'}
+ALL_TABLE_ROUTES = {'/get_table_names', '/get_tables'}
+
+def _request_table_name():
+    # The table named in this request: the table field of the JSON body for a POST, the table_name argument for a GET
+    if request.method == 'POST':
+        body = request.get_json(silent = True)
+        return body.get('table') if isinstance(body, dict) else None
+    return request.args.get('table_name')
+
+def _add_cache_headers(response, etag):
+    # Clients may store the response, but must revalidate it on each use
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def add_conditional_caching(app, table_version):
+    '''
+    Add ETag and Cache-Control headers to the responses to the routes in CACHED_ROUTES, and answer
+    a request with a 304 if its If-None-Match header matches
+    Arguments:
+      - app: the Flask app serving the SDTP routes
+      - table_version: a function of a table name which returns the version of that table, or None if there is no
+        such table.  It is called with None for the routes in ALL_TABLE_ROUTES, and then returns the version of all tables
+    '''
+    @app.before_request
+    def check_etag():
+        if request.path not in CACHED_ROUTES: return None
+        version = table_version(None if request.path in ALL_TABLE_ROUTES else _request_table_name())
+        if version is None: return None
+        key = f'{version}|{request.method}|{request.full_path}|'.encode() + request.get_data()
+        g.etag = hashlib.sha256(key).hexdigest()
+        if request.if_none_match.contains_weak(g.etag):
+            return _add_cache_headers(Response(status = 304), g.etag)
+        return None
+
+    @app.after_request
+    def add_etag(response):
+        etag = g.get('etag')
+        if etag is not None and response.status_code == 200:
+            _add_cache_headers(response, etag)
+        return response